@@ -8,6 +8,7 @@ import argparse
 import os
 import random
 import time
+import warnings
 from distutils.util import strtobool
 from typing import Union
 import gym
@@ -15,6 +16,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.distributions.categorical import Categorical
 from torch.utils.tensorboard import SummaryWriter
 from MathLang import MathLang
@@ -22,7 +25,8 @@ from LambdaLang import LambdaLang
 from rejoice import envs, EGraph
 import time
 
-from rejoice.networks import SAGENetwork, GATNetwork, GCNNetwork, GraphTransformerNetwork, GINNetwork
+from rejoice.networks import SAGENetwork, GATNetwork, GATActorCritic, GCNNetwork, GraphTransformerNetwork, GINNetwork
+from rejoice.rollout import gae_decay_table, compute_gae, GraphRolloutStorage
 
 
 def parse_args():
@@ -35,6 +39,13 @@ def parse_args():
                         help="if toggled, `torch.backends.cudnn.deterministic=False`")
     parser.add_argument("--cuda", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
                         help="if toggled, cuda will be enabled by default")
+    parser.add_argument("--cuda-graphs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, minibatch updates are captured and replayed as CUDA graphs "
+                             "(needs PyG >= 2.4 for the padded GraphNorm path; ignored otherwise)")
+    parser.add_argument("--bf16", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the GNN forward passes run under bfloat16 autocast (CUDA only)")
+    parser.add_argument("--torch-compile", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the GNN trunk is compiled with torch.compile (dynamic shapes)")
 
     # omelette-specific configuration
     parser.add_argument("--mode", type=str, choices=["single_task_sat", "single_task_explodes", "bc", "multitask"], default="single_task_sat")
@@ -150,6 +161,7 @@ def make_env(env_id, seed, idx: int, input_expr, run_name: str, max_episode_step
             expr = lang.eval_expr(input_expr)
 
         env = gym.make(env_id, disable_env_checker=True, lang=lang, expr=expr, use_shrink_action=use_shrink_action, node_limit=node_limit)
+        env = NumpyGraphObservation(env)
         env = gym.wrappers.TimeLimit(env, max_episode_steps=max_episode_steps)
         env = gym.wrappers.RecordEpisodeStatistics(env)
         env.reset(seed=seed)
@@ -159,6 +171,38 @@ def make_env(env_id, seed, idx: int, input_expr, run_name: str, max_episode_step
     return thunk
 
 
+class NumpyGraphObservation(gym.ObservationWrapper):
+    """Turns each egraph `Data` observation into a tuple of (x, edge_index, edge_attr, action_mask) arrays.
+
+    Vector env workers send observations back over pipes; plain NumPy arrays pickle as bytes, while
+    torch tensors are moved through shared-memory file descriptors, which is slow for many small graphs.
+    Use `collate_numpy_obs` to batch them again on the training side.
+    """
+
+    def observation(self, observation):
+        if observation is None:
+            return None
+        return (observation.x.numpy(), observation.edge_index.numpy(),
+                observation.edge_attr.numpy(), observation.action_mask.numpy())
+
+
+def collate_numpy_obs(obs) -> pyg.data.Batch:
+    """Batch the per-env arrays of `NumpyGraphObservation` into one CPU `Batch`."""
+    xs, edge_indices, edge_attrs, action_masks = zip(*obs)
+    num_nodes = torch.tensor([x.shape[0] for x in xs])
+    num_edges = torch.tensor([ei.shape[1] for ei in edge_indices])
+    ptr = torch.cat([num_nodes.new_zeros(1), torch.cumsum(num_nodes, 0)])
+    edge_index = torch.from_numpy(np.concatenate(edge_indices, axis=1)) + \
+        torch.repeat_interleave(ptr[:-1], num_edges)
+    return pyg.data.Batch(x=torch.from_numpy(np.concatenate(xs)),
+                          edge_index=edge_index,
+                          edge_attr=torch.from_numpy(np.concatenate(edge_attrs)),
+                          action_mask=torch.from_numpy(np.concatenate(action_masks)),
+                          batch=torch.repeat_interleave(torch.arange(len(xs)), num_nodes),
+                          ptr=ptr,
+                          edge_counts=num_edges)
+
+
 def get_lang_from_str(name: str) -> Language:
     if name in ["PROP", "PropLang"]:
         return PropLang()
@@ -168,6 +212,81 @@ def get_lang_from_str(name: str) -> Language:
         return LambdaLang()
 
 
+def normalize_advantages(advantages, is_distributed: bool = False):
+    """Standardize advantages. In distributed runs the mean and std are taken over every rank's rollout."""
+    if not is_distributed:
+        return (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+
+    # (sum, sum of squares, count) is all that is needed for the global moments
+    flat = advantages.double()
+    stats = torch.stack([flat.sum(), (flat ** 2).sum(), flat.new_tensor(flat.numel())])
+    dist.all_reduce(stats)
+    total, total_sq, count = stats
+    mean = total / count
+    std = ((total_sq - count * mean ** 2) / (count - 1)).clamp_min(0).sqrt()
+    return ((advantages - mean) / (std + 1e-8)).to(advantages.dtype)
+
+
+class PinnedHostStager:
+    """Moves CPU tensors to the device through reusable pinned buffers on a side CUDA stream.
+
+    Copies are issued with `non_blocking=True` so they overlap with whatever is running on the
+    compute stream; call `wait` before the staged tensors are used. On a CPU device this is a
+    plain `.to(device)`.
+    """
+
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+        self.buffers = {}
+        self.staged = []
+        self.copy_done = None
+        if self.use_cuda:
+            self.stream = torch.cuda.Stream(device)
+
+    def _host_buffer(self, name: str, src: torch.Tensor) -> torch.Tensor:
+        buf = self.buffers.get(name)
+        if buf is None or buf.dtype != src.dtype or buf.numel() < src.numel():
+            # grow geometrically, the egraphs tend to get bigger over an episode
+            size = max(src.numel(), 2 * buf.numel() if buf is not None else 0)
+            buf = torch.empty(size, dtype=src.dtype, pin_memory=True)
+            self.buffers[name] = buf
+        return buf[:src.numel()].view(src.shape)
+
+    def stage(self, **tensors) -> dict:
+        if not self.use_cuda:
+            return {name: t.to(self.device) for name, t in tensors.items()}
+
+        # the pinned buffers are reused, so the previous copies out of them must have landed
+        if self.copy_done is not None:
+            self.copy_done.synchronize()
+        staged = {}
+        with torch.cuda.stream(self.stream):
+            for name, t in tensors.items():
+                host = self._host_buffer(name, t)
+                host.copy_(t)
+                staged[name] = host.to(self.device, non_blocking=True)
+            self.copy_done = self.stream.record_event()
+        self.staged.extend(staged.values())
+        return staged
+
+    def stage_batch(self, batch: pyg.data.Batch) -> pyg.data.Batch:
+        return pyg.data.Batch(**self.stage(x=batch.x, edge_index=batch.edge_index, edge_attr=batch.edge_attr,
+                                           batch=batch.batch, ptr=batch.ptr, action_mask=batch.action_mask,
+                                           edge_counts=batch.edge_counts))
+
+    def wait(self):
+        """Make the current stream wait for all staged copies."""
+        if not self.use_cuda:
+            return
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_stream(self.stream)
+        for t in self.staged:
+            # allocated on the side stream but consumed here
+            t.record_stream(stream)
+        self.staged = []
+
+
 class CategoricalMasked(Categorical):
     def __init__(self, probs=None, logits=None, validate_args=None, mask=None, device=torch.device("cuda")):
         self.mask = mask
@@ -193,50 +312,255 @@ class CategoricalMasked(Categorical):
         return -p_log_p.sum(-1)
 
 
+# checkpoints saved before the trunk was shared hold separate actor and critic GATNetworks
+_LEGACY_ACTOR_KEY_PREFIXES = (("actor.gnn.", "network.gnn."),
+                              ("actor.head.", "network.actor_head."))
+
+
+def _migrate_legacy_agent_state_dict(agent, state_dict, prefix, *args):
+    """Load-state-dict pre-hook mapping legacy actor.*/critic.* checkpoints onto `PPOAgent.network`."""
+    legacy_keys = [k for k in state_dict if k.startswith(prefix + "actor.") or k.startswith(prefix + "critic.")]
+    if not legacy_keys:
+        return
+    for key in legacy_keys:
+        name = key[len(prefix):]
+        for old, new in _LEGACY_ACTOR_KEY_PREFIXES:
+            if name.startswith(old):
+                state_dict[prefix + new + name[len(old):]] = state_dict.pop(key)
+                break
+        else:
+            if name.startswith("critic."):
+                del state_dict[key]
+    # the old value head was trained on the critic's own trunk, so it doesn't fit the shared one
+    for name, value in agent.network.critic_head.state_dict().items():
+        state_dict[prefix + "network.critic_head." + name] = value
+    warnings.warn("Converted a checkpoint with separate actor/critic networks: the actor is loaded onto the "
+                  "shared trunk, the critic is discarded and the value head starts from a fresh init.")
+
+
 class PPOAgent(nn.Module):
     def __init__(self, n_actions: int, n_node_features: int, weights_path=None, use_dropout=False, use_edge_attr=True, device=torch.device("cuda")):
         super().__init__()
         print("use_edge_attr", use_edge_attr, "use_dropout", use_dropout, "weights_path", weights_path)
         self.device = device
-        self.critic = GATNetwork(num_node_features=n_node_features,
-                                 n_actions=1,
-                                 n_layers=3,
-                                 hidden_size=64,
-                                 dropout=(0.3 if use_dropout else 0.0),
-                                 use_edge_attr=use_edge_attr,
-                                 out_std=1.)
-        self.actor = GATNetwork(num_node_features=n_node_features,
-                                n_actions=n_actions,
-                                n_layers=3,
-                                hidden_size=64,
-                                dropout=(0.3 if use_dropout else 0.0),
-                                use_edge_attr=use_edge_attr,
-                                out_std=0.001)  # make probability of each action similar to start with
+        self.network = GATActorCritic(num_node_features=n_node_features,
+                                      n_actions=n_actions,
+                                      n_layers=3,
+                                      hidden_size=64,
+                                      dropout=(0.3 if use_dropout else 0.0),
+                                      use_edge_attr=use_edge_attr,
+                                      actor_out_std=0.001,  # make probability of each action similar to start with
+                                      critic_out_std=1.)
 
         if weights_path is not None:
-            self.actor.load_state_dict(torch.load(weights_path))
-            keys_vin = torch.load(weights_path)
-            current_model = self.critic.state_dict()
-            new_state_dict = {k: v if v.size() == current_model[k].size() else current_model[k] for k, v in zip(
-                current_model.keys(), keys_vin.values())}
-            self.critic.load_state_dict(new_state_dict, strict=False)
+            # pretrained weights come from a standalone GATNetwork policy (gnn + head)
+            pretrained = torch.load(weights_path)
+            self.network.gnn.load_state_dict(
+                {k[len("gnn."):]: v for k, v in pretrained.items() if k.startswith("gnn.")})
+            head = {k[len("head."):]: v for k, v in pretrained.items() if k.startswith("head.")}
+            self.network.actor_head.load_state_dict(head)
+            current_critic = self.network.critic_head.state_dict()
+            self.network.critic_head.load_state_dict(
+                {k: v for k, v in head.items() if v.size() == current_critic[k].size()}, strict=False)
+
+        self.register_load_state_dict_pre_hook(_migrate_legacy_agent_state_dict)
 
     def get_value(self, x):
-        return self.critic(x)
+        return self.network.critic_head(self.network.embed(x)).float()
 
-    def get_action_and_value(self, x, action=None, invalid_action_mask=None):
-        logits = self.actor(x)
+    def get_action_and_value(self, x, action=None, invalid_action_mask=None, compute_value=True, num_graphs=None):
+        # both heads share the trunk embedding; skip the value head for pure policy rollouts
+        h = self.network.embed(x, num_graphs=num_graphs)
+        # heads may run under autocast; the distribution and losses are always computed in fp32
+        logits = self.network.actor_head(h).float()
+        value = self.network.critic_head(h).float() if compute_value else None
 
         if invalid_action_mask is not None:
             probs = CategoricalMasked(
                 logits=logits, mask=invalid_action_mask, device=self.device)
         else:
-            probs = Categorical(logits=logits)
+            # argument validation syncs with the host, which a padded (graph-captured) call can't do
+            probs = Categorical(logits=logits, validate_args=(False if num_graphs is not None else None))
 
         if action is None:
             action = probs.sample()
 
-        return action, probs.log_prob(action), probs.entropy(), self.critic(x)
+        return action, probs.log_prob(action), probs.entropy(), value
+
+    def forward(self, x, action=None, invalid_action_mask=None, compute_value=True, num_graphs=None):
+        # DistributedDataParallel only syncs gradients for calls that go through forward()
+        return self.get_action_and_value(x, action, invalid_action_mask, compute_value, num_graphs)
+
+def gnn_autocast(enabled: bool):
+    """bfloat16 autocast for the GNN forward passes, a no-op when disabled.
+
+    The autocast weight cache is turned off so the same context also works inside CUDA graph capture.
+    """
+    return torch.autocast("cuda", dtype=torch.bfloat16, enabled=enabled, cache_enabled=False)
+
+
+def ppo_update_step(agent, optimizer, args, mb_obs, mb_actions, mb_logprobs, mb_advantages, mb_returns, mb_values,
+                    num_graphs=None):
+    """One PPO gradient step on a minibatch. Returns the (detached) loss terms and statistics.
+
+    Advantages are expected to be normalized already (once over the whole batch).
+
+    `agent` may be wrapped in DistributedDataParallel. `num_graphs` is forwarded to the agent for padded, static-shape minibatches (see `CUDAGraphTrainStep`).
+    """
+    with gnn_autocast(args.bf16 and mb_logprobs.is_cuda):
+        _, newlogprob, entropy, newvalue = agent(
+            mb_obs, mb_actions, num_graphs=num_graphs)
+    logratio = newlogprob - mb_logprobs
+    ratio = logratio.exp()
+
+    with torch.no_grad():
+        # calculate approx_kl http://joschu.net/blog/kl-approx.html
+        old_approx_kl = (-logratio).mean()
+        approx_kl = ((ratio - 1) - logratio).mean()
+        clipfrac = ((ratio - 1.0).abs() > args.clip_coef).float().mean()
+
+    # Policy loss
+    pg_loss1 = -mb_advantages * ratio
+    pg_loss2 = -mb_advantages * \
+        torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
+    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+    # Value loss
+    newvalue = newvalue.view(-1)
+    if args.clip_vloss:
+        v_loss_unclipped = (newvalue - mb_returns) ** 2
+        v_clipped = mb_values + torch.clamp(
+            newvalue - mb_values,
+            -args.clip_coef,
+            args.clip_coef,
+        )
+        v_loss_clipped = (v_clipped - mb_returns) ** 2
+        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+        v_loss = 0.5 * v_loss_max.mean()
+    else:
+        v_loss = 0.5 * \
+            ((newvalue - mb_returns) ** 2).mean()
+
+    entropy_loss = entropy.mean()
+    loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+
+    optimizer.zero_grad(set_to_none=True)
+    loss.backward()
+    nn.utils.clip_grad_norm_(
+        agent.parameters(), args.max_grad_norm)
+    optimizer.step()
+
+    return pg_loss.detach(), v_loss.detach(), entropy_loss.detach(), old_approx_kl, approx_kl, clipfrac
+
+
+def _next_pow2(n: int) -> int:
+    return 1 << (n - 1).bit_length()
+
+
+class CUDAGraphTrainStep:
+    """Runs `ppo_update_step` through CUDA graphs, one per minibatch shape bucket.
+
+    A minibatch is padded up to power-of-two node and edge counts. The padding nodes form one
+    extra graph (edges are self loops on the last padding node), so they never exchange messages
+    with real nodes. The first minibatch of a bucket is run eagerly on a side stream as the
+    warmup, then forward + backward + optimizer step are captured; later minibatches of that
+    bucket are copied into the static inputs and replayed. All graphs share one memory pool.
+
+    The optimizer must be created with `capturable=True` (and a tensor lr if it is annealed).
+    """
+
+    def __init__(self, agent, optimizer, args):
+        self.agent = agent
+        self.optimizer = optimizer
+        self.args = args
+        self.pool = torch.cuda.graph_pool_handle()
+        self.graphs = {}
+
+    def __call__(self, mb_obs, mb_actions, mb_logprobs, mb_advantages, mb_returns, mb_values):
+        num_graphs = mb_logprobs.numel()
+        num_nodes, num_edges = mb_obs.x.size(0), mb_obs.edge_index.size(1)
+        # +1 so there is always at least one padding node for the padding edges to point at
+        key = (num_graphs, _next_pow2(num_nodes + 1), _next_pow2(num_edges + 1))
+
+        entry = self.graphs.get(key)
+        captured = entry is not None
+        if not captured:
+            entry = self._static_inputs(mb_obs, *key)
+            self.graphs[key] = entry
+        self._fill(entry, mb_obs, mb_actions, mb_logprobs, mb_advantages, mb_returns, mb_values)
+
+        if captured:
+            entry["graph"].replay()
+            return tuple(out.clone() for out in entry["outputs"])
+
+        # warmup (this minibatch's real update) on a side stream, then capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            outputs = tuple(out.clone() for out in self._step(entry))
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        self.optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(graph, pool=self.pool):
+            entry["outputs"] = self._step(entry)
+        entry["graph"] = graph
+        return outputs
+
+    def _step(self, entry):
+        return ppo_update_step(self.agent, self.optimizer, self.args, entry["obs"], entry["actions"],
+                               entry["logprobs"], entry["advantages"], entry["returns"], entry["values"],
+                               num_graphs=entry["num_graphs"])
+
+    @staticmethod
+    def _static_inputs(mb_obs, num_graphs, max_nodes, max_edges):
+        device = mb_obs.x.device
+        obs = pyg.data.Batch(
+            x=mb_obs.x.new_zeros((max_nodes,) + mb_obs.x.shape[1:]),
+            edge_index=mb_obs.edge_index.new_zeros((2, max_edges)),
+            edge_attr=mb_obs.edge_attr.new_zeros((max_edges,) + mb_obs.edge_attr.shape[1:]),
+            batch=torch.zeros(max_nodes, dtype=torch.long, device=device))
+        return {
+            "num_graphs": num_graphs,
+            "obs": obs,
+            "actions": torch.zeros(num_graphs, dtype=torch.long, device=device),
+            "logprobs": torch.zeros(num_graphs, device=device),
+            "advantages": torch.zeros(num_graphs, device=device),
+            "returns": torch.zeros(num_graphs, device=device),
+            "values": torch.zeros(num_graphs, device=device),
+        }
+
+    @staticmethod
+    def _fill(entry, mb_obs, mb_actions, mb_logprobs, mb_advantages, mb_returns, mb_values):
+        obs = entry["obs"]
+        num_nodes, num_edges = mb_obs.x.size(0), mb_obs.edge_index.size(1)
+        obs.x[:num_nodes].copy_(mb_obs.x)
+        obs.x[num_nodes:].zero_()
+        obs.batch[:num_nodes].copy_(mb_obs.batch)
+        obs.batch[num_nodes:].fill_(entry["num_graphs"])
+        obs.edge_index[:, :num_edges].copy_(mb_obs.edge_index)
+        obs.edge_index[:, num_edges:].fill_(obs.x.size(0) - 1)
+        obs.edge_attr[:num_edges].copy_(mb_obs.edge_attr)
+        obs.edge_attr[num_edges:].zero_()
+        entry["actions"].copy_(mb_actions)
+        entry["logprobs"].copy_(mb_logprobs)
+        entry["advantages"].copy_(mb_advantages)
+        entry["returns"].copy_(mb_returns)
+        entry["values"].copy_(mb_values)
+
+
+class NullSummaryWriter:
+    """Stands in for the SummaryWriter on non-zero ranks, so only rank 0 writes TensorBoard logs."""
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def add_text(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
 
 class DictObj:
     def __init__(self, in_dict:dict):
@@ -251,8 +575,20 @@ def run_ppo(**kwargs):
     all_args = vars(parse_args()) | kwargs
     args = DictObj(all_args)
     torch.cuda.empty_cache()
+
+    # multi-GPU runs are launched with torchrun, which sets these; each rank rolls out its own envs
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    is_distributed = world_size > 1
+    use_cuda = torch.cuda.is_available() and args.cuda
+    if is_distributed:
+        dist.init_process_group(backend="nccl" if use_cuda else "gloo")
+        if use_cuda:
+            torch.cuda.set_device(local_rank)
+
     run_name = f"{args.env_id}__{args.exp_name}__{args.seed}__{int(time.time())}"
-    writer = SummaryWriter(f"ppo_logs/{run_name}")
+    writer = SummaryWriter(f"ppo_logs/{run_name}") if rank == 0 else NullSummaryWriter()
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s" % (
@@ -279,11 +615,11 @@ def run_ppo(**kwargs):
     )
 
     # Seed random number generators for reproducible results
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    random.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
     torch.backends.cudnn.deterministic = args.torch_deterministic
-    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    device = torch.device(f"cuda:{local_rank}" if use_cuda else "cpu")
 
     print("lang", args.lang, "device:", device, "use_shrink", args.use_shrink_action)
     lang = get_lang_from_str(args.lang)
@@ -294,12 +630,13 @@ def run_ppo(**kwargs):
 
     # env setup
     print("spawning envs")
+    env_offset = rank * args.num_envs
     if args.num_envs == 1:
-        envs = gym.vector.SyncVectorEnv([make_env(env_id=args.env_id, input_expr=args.expr_str, seed=args.seed + i, idx=i, run_name=run_name,
+        envs = gym.vector.SyncVectorEnv([make_env(env_id=args.env_id, input_expr=args.expr_str, seed=args.seed + env_offset + i, idx=env_offset + i, run_name=run_name,
                     max_episode_steps=args.max_episode_steps, lang_name=args.lang, use_shrink_action=args.use_shrink_action, node_limit=args.node_limit, num_egg_iter=args.num_egg_iter, mode=args.mode, multitask_count=args.multitask_count) for i in range(args.num_envs)])
     else:
         envs = gym.vector.AsyncVectorEnv(
-            [make_env(env_id=args.env_id, input_expr=args.expr_str, seed=args.seed + i, idx=i, run_name=run_name,
+            [make_env(env_id=args.env_id, input_expr=args.expr_str, seed=args.seed + env_offset + i, idx=env_offset + i, run_name=run_name,
                     max_episode_steps=args.max_episode_steps, lang_name=args.lang, use_shrink_action=args.use_shrink_action, node_limit=args.node_limit, num_egg_iter=args.num_egg_iter, mode=args.mode, multitask_count=args.multitask_count) for i in range(args.num_envs)],
             shared_memory=False,
             copy=False
@@ -312,14 +649,39 @@ def run_ppo(**kwargs):
 
     agent = PPOAgent(
         n_node_features=envs.single_observation_space.num_node_features, n_actions=envs.single_action_space.n, weights_path=args.pretrained_weights_path, use_dropout=False, use_edge_attr=args.use_edge_attr, device=device).to(device)
-    optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    # graph capture doesn't cover DDP's gradient all-reduce
+    use_cuda_graphs = args.cuda_graphs and device.type == "cuda" and not is_distributed
+    if use_cuda_graphs and tuple(int(v) for v in pyg.__version__.split(".")[:2]) < (2, 4):
+        # older BasicGNN.forward doesn't pass batch/batch_size through to GraphNorm
+        warnings.warn(f"--cuda-graphs needs PyG >= 2.4 (found {pyg.__version__}), running eagerly")
+        use_cuda_graphs = False
+    use_bf16 = args.bf16 and device.type == "cuda"
+    # the fused kernel updates every parameter tensor in one launch (CUDA only).
+    # captured CUDA graphs read the lr in place, so it has to be a device tensor for annealing.
+    optimizer = optim.Adam(agent.parameters(),
+                           lr=(torch.tensor(args.learning_rate, device=device) if use_cuda_graphs else args.learning_rate),
+                           eps=1e-5,
+                           fused=device.type == "cuda",
+                           capturable=use_cuda_graphs)
 
     if args.agent_weights_path is not None:
         print("Loading learned weights from RL agent")
         agent.load_state_dict(torch.load(args.agent_weights_path))
 
+    # allow TF32 for the dense projections inside the GAT layers
+    torch.set_float32_matmul_precision("high")
+    if args.torch_compile:
+        # compiled in place so the state_dict keys (and saved weights) are unchanged.
+        # the number of nodes varies with the egraph, hence dynamic shapes.
+        agent.network.gnn.compile(dynamic=True)
+
+    # gradients are all-reduced across ranks during backward; rollouts use the unwrapped agent
+    train_agent = DistributedDataParallel(agent, device_ids=([local_rank] if use_cuda else None)) \
+        if is_distributed else agent
+    train_step_graphs = CUDAGraphTrainStep(agent, optimizer, args) if use_cuda_graphs else None
+
     # ALGO Logic: Storage setup
-    obs = np.empty(args.num_steps, dtype=object)
+    obs = GraphRolloutStorage(args.num_steps)
     actions = torch.zeros((args.num_steps, args.num_envs) +
                           envs.single_action_space.shape).to(device)
     logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
@@ -333,25 +695,35 @@ def run_ppo(**kwargs):
     global_step = 0
     start_time = time.time()
     # Intial observation
-    next_obs = pyg.data.Batch.from_data_list(envs.reset()).to(device)
+    obs_stager = PinnedHostStager(device)
+    next_obs = obs_stager.stage_batch(collate_numpy_obs(envs.reset()))
     next_done = torch.zeros(args.num_envs).to(device)
-    num_updates = args.total_timesteps // args.batch_size
+    reward_host = torch.empty(args.num_envs, pin_memory=device.type == "cuda")
+    done_host = torch.empty(args.num_envs, pin_memory=device.type == "cuda")
+    action_host = torch.empty(args.num_envs, dtype=torch.long, pin_memory=device.type == "cuda")
+    action_copied = torch.cuda.Event() if device.type == "cuda" else None
+    num_updates = args.total_timesteps // (args.batch_size * world_size)
+    gl_pow = gae_decay_table(args.num_steps, args.gamma, args.gae_lambda, device=device)
 
     for update in range(1, num_updates + 1):
         # Annealing the learning rate if instructed to do so.
         if args.anneal_lr:
             frac = 1.0 - (update - 1.0) / num_updates
             lrnow = frac * args.learning_rate
-            optimizer.param_groups[0]["lr"] = lrnow
+            if torch.is_tensor(optimizer.param_groups[0]["lr"]):
+                optimizer.param_groups[0]["lr"].fill_(lrnow)
+            else:
+                optimizer.param_groups[0]["lr"] = lrnow
 
         # Policy rollout across envs
         for step in range(0, args.num_steps):
-            global_step += 1 * args.num_envs
+            global_step += 1 * args.num_envs * world_size
 
             if update == 1:
                 envs.call("set_global_step", step)
             # nvs.set_attr("global_step", global_step)
             # add the batch of 4 env observations to the obs list at index step
+            obs_stager.wait()
             obs[step] = next_obs
             dones[step] = next_done
 
@@ -360,7 +732,7 @@ def run_ppo(**kwargs):
                     (args.num_envs, envs.single_action_space.n))
 
             # log the action, logprob, and value for this step into our data storage
-            with torch.no_grad():  # no grad b/c we're just rolling out, not training
+            with torch.no_grad(), gnn_autocast(use_bf16):  # no grad b/c we're just rolling out, not training
                 if args.use_action_mask:
                     action, logprob, _, value = agent.get_action_and_value(
                         next_obs, invalid_action_mask=invalid_action_masks[step])
@@ -371,12 +743,20 @@ def run_ppo(**kwargs):
             actions[step] = action
             logprobs[step] = logprob
             # execute the chosen action
-            next_obs, reward, done, info = envs.step(action.cpu().numpy())
+            # copy the sampled actions into the pinned buffer and only wait for that copy
+            action_host.copy_(action, non_blocking=True)
+            if device.type == "cuda":
+                action_copied.record()
+                action_copied.synchronize()
+            next_obs, reward, done, info = envs.step(action_host.numpy())
             # log the reward into data storage at this step
-            rewards[step] = torch.tensor(reward).to(device).view(-1)
-            next_done = torch.Tensor(done).to(device)
-            # convert next obs to a pytorch geometric batch
-            next_obs = pyg.data.Batch.from_data_list(next_obs).to(device)
+            # the host buffers can be reused next step: its action sync also waits for these copies
+            reward_host.copy_(torch.from_numpy(np.asarray(reward, dtype=np.float32)).view(-1))
+            rewards[step].copy_(reward_host, non_blocking=True)
+            done_host.copy_(torch.from_numpy(np.asarray(done, dtype=np.float32)))
+            next_done.copy_(done_host, non_blocking=True)
+            # convert next obs to a pytorch geometric batch and start copying it to the device
+            next_obs = obs_stager.stage_batch(collate_numpy_obs(next_obs))
 
 
             if "episode" in info.keys():
@@ -437,22 +817,13 @@ def run_ppo(**kwargs):
 
         # Remember that actions is (n_steps, n_envs, n_actions)
         # bootstrap value if not done
+        obs_stager.wait()
         with torch.no_grad():
-            next_value = agent.get_value(next_obs).reshape(1, -1)
+            with gnn_autocast(use_bf16):
+                next_value = agent.get_value(next_obs).reshape(1, -1)
             if args.gae:
-                advantages = torch.zeros_like(rewards).to(device)
-                lastgaelam = 0
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        nextvalues = next_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        nextvalues = values[t + 1]
-                    delta = rewards[t] + args.gamma * \
-                        nextvalues * nextnonterminal - values[t]
-                    advantages[t] = lastgaelam = delta + args.gamma * \
-                        args.gae_lambda * nextnonterminal * lastgaelam
+                advantages = compute_gae(rewards, values, dones, next_value, next_done,
+                                         gamma=args.gamma, gae_lambda=args.gae_lambda, gl_pow=gl_pow)
                 returns = advantages + values
             else:
                 returns = torch.zeros_like(rewards).to(device)
@@ -468,78 +839,48 @@ def run_ppo(**kwargs):
                 advantages = returns - values
 
         # flatten the batch
-        all_obs_raw = []
-        for step_batch in obs:
-            # TODO: this is a performance hog. Find a diff way?
-            all_obs_raw += step_batch.to_data_list()
-        b_obs = pyg.data.Batch.from_data_list(all_obs_raw)
+        b_obs = obs.flatten()
 
         b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,) + envs.single_action_space.shape)
+        b_actions = actions.reshape((-1,) + envs.single_action_space.shape).long()
         b_advantages = advantages.reshape(-1)
         b_returns = returns.reshape(-1)
         b_values = values.reshape(-1)
+        if args.norm_adv:
+            b_advantages = normalize_advantages(b_advantages, is_distributed)
         # Optimizing the policy and value network (learn!)
-        b_inds = np.arange(args.batch_size)
-        clipfracs = []
+        # kept on the device and only read back once per update, to avoid a host sync per minibatch
+        clipfracs = torch.zeros(args.update_epochs * len(range(0, args.batch_size, args.minibatch_size)),
+                                device=device)
+        num_clipfracs = 0
         # update_epochs num of gradient updates
         for epoch in range(args.update_epochs):
-            np.random.shuffle(b_inds)
+            # shuffled on the device, so minibatch gathers never copy indices from the host
+            b_inds = torch.randperm(args.batch_size, device=device)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                mb_batch_obs = pyg.data.Batch.from_data_list(b_obs[mb_inds])
-
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(
-                    mb_batch_obs, b_actions.long()[mb_inds])
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
-
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs += [((ratio - 1.0).abs() >
-                                   args.clip_coef).float().mean().item()]
-
-                mb_advantages = b_advantages[mb_inds]
-                if args.norm_adv:
-                    mb_advantages = (
-                        mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * \
-                    torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args.clip_coef,
-                        args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * \
-                        ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+                mb_batch_obs = b_obs[mb_inds]
 
-                optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_norm_(
-                    agent.parameters(), args.max_grad_norm)
-                optimizer.step()
+                mb_args = (mb_batch_obs, b_actions[mb_inds], b_logprobs[mb_inds],
+                           b_advantages[mb_inds], b_returns[mb_inds], b_values[mb_inds])
+                if train_step_graphs is not None:
+                    pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac = train_step_graphs(*mb_args)
+                else:
+                    pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac = ppo_update_step(
+                        train_agent, optimizer, args, *mb_args)
+                clipfracs[num_clipfracs] = clipfrac
+                num_clipfracs += 1
 
+            # checked once per epoch rather than per minibatch. Eager minibatches still sync elsewhere
+            # (repeat_interleave in the gather, global_add_pool sizing, Categorical validation)
             if args.target_kl is not None:
+                if is_distributed:
+                    # every rank has to agree on stopping, or the next epoch's gradient all-reduce hangs
+                    approx_kl = approx_kl.clone()
+                    dist.all_reduce(approx_kl)
+                    approx_kl /= world_size
                 if approx_kl > args.target_kl:
                     break
 
@@ -550,17 +891,18 @@ def run_ppo(**kwargs):
 
         # TRY NOT TO MODIFY: record rewards for plotting purposes
         writer.add_scalar("charts/learning_rate",
-                          optimizer.param_groups[0]["lr"], global_step)
+                          float(optimizer.param_groups[0]["lr"]), global_step)
         writer.add_scalar("losses/value_loss", v_loss.item(), global_step)
         writer.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
         writer.add_scalar("losses/entropy", entropy_loss.item(), global_step)
         writer.add_scalar("losses/old_approx_kl",
                           old_approx_kl.item(), global_step)
         writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
-        writer.add_scalar("losses/clipfrac", np.mean(clipfracs), global_step)
+        writer.add_scalar("losses/clipfrac", clipfracs[:num_clipfracs].mean().item(), global_step)
         writer.add_scalar("losses/explained_variance",
                           explained_var, global_step)
-        print("SPS:", int(global_step / (time.time() - start_time)))
+        if rank == 0:
+            print("SPS:", int(global_step / (time.time() - start_time)))
         writer.add_scalar("charts/SPS", int(global_step /
                           (time.time() - start_time)), global_step)
 
@@ -568,7 +910,10 @@ def run_ppo(**kwargs):
     writer.close()
 
     # Save weights of agent now that it's been trained
-    torch.save(agent.state_dict(), f"{weights_output_path}/{args.exp_name}")
+    if rank == 0:
+        torch.save(agent.state_dict(), f"{weights_output_path}/{args.exp_name}")
+    if is_distributed:
+        dist.destroy_process_group()
     return agent
 
 
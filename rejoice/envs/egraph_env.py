@@ -38,6 +38,8 @@ class EGraphEnv(gym.Env):
         self.reward_range = (-1, 1)
         self.node_limit = node_limit
         self.egraph, self.max_cost, self.prev_cost, self.best_seen_cost = None, None, None, None
+        # bumped whenever self.egraph changes, so unchanged egraphs aren't re-encoded
+        self.egraph_version = 0
 
         self.acc_rewrites = 0
 
@@ -74,6 +76,7 @@ class EGraphEnv(gym.Env):
             # re-create the egraph given this new expression
             self.egraph = EGraph()
             self.egraph.add(self.expr)
+            self.egraph_version += 1
             self.prev_cost = float(self.egraph.extract(self.expr)[0])
             # print("rebase get_obs")
             new_obs = self._get_obs()
@@ -104,6 +107,8 @@ class EGraphEnv(gym.Env):
         info["acc_rewrites"] = self.acc_rewrites
 
         info["stop_reason"] = stop_reason
+        if stop_reason != 'SATURATED':
+            self.egraph_version += 1
         if stop_reason == 'SATURATED':
             # if it was saturated, applying the rule did nothing; no need to re-extract
             reward = -0.2
@@ -149,6 +154,7 @@ class EGraphEnv(gym.Env):
         self.egraph = EGraph()
         self.expr = self.orig_expr
         self.egraph.add(self.expr)
+        self.egraph_version += 1
         self.acc_rewrites = 0
         self.max_cost = float(self.egraph.extract(self.expr)[0])
         self.prev_cost = self.max_cost
@@ -163,7 +169,8 @@ class EGraphEnv(gym.Env):
             return new_obs
 
     def _get_obs(self):
-        return self.lang.encode_egraph(self.egraph, use_shrink_action=self.use_shrink_action, step=self.step_count)
+        return self.lang.encode_egraph(self.egraph, use_shrink_action=self.use_shrink_action, step=self.step_count,
+                                       version=self.egraph_version)
 
     def close(self):
         pass
@@ -118,6 +118,21 @@ class Language(Protocol):
             op_to_ind_table[op] = ind
         return op_to_ind_table
 
+    @functools.cached_property
+    def terminal_to_ind(self):
+        terminal_to_ind_table = {}
+        for ind, term in enumerate(self.get_terminals()):
+            # keep the first match, like list.index
+            terminal_to_ind_table.setdefault(term, ind)
+        return terminal_to_ind_table
+
+    @functools.cached_property
+    def rule_to_ind(self):
+        rule_to_ind_table = {}
+        for ind, rl_name in enumerate(self.rule_names):
+            rule_to_ind_table.setdefault(rl_name, ind)
+        return rule_to_ind_table
+
     def gen_expr(self, root_op=None, p_leaf=0.6, depth=0):
         """Generate an arbitrary expression which abides by the language."""
         depth_limit = 6
@@ -152,119 +167,141 @@ class Language(Protocol):
         return len(self.all_rules())
 
     def rule_name_to_ind(self, rname: str) -> int:
-        rl_names = [rl[0] for rl in self.all_rules()]
-        return rl_names.index(rname)
+        return self.rule_to_ind[rname]
 
     @functools.cached_property
     def rule_names(self) -> list[str]:
         rl_names = [rl[0] for rl in self.all_rules()]
         return rl_names
 
-    def matches_to_lookup(self, eclass_ids: "list[str]", matches):
-        # restructure the dict
-        eclass_lookup = {k: [0]*self.num_rules for k in eclass_ids}
+    @functools.cached_property
+    def _encode_cache(self) -> dict:
+        """(id(egraph), version) -> (x, edge_index, edge_attr) of the last versioned `encode_egraph` call."""
+        return {}
+
+    def encode_egraph(self, egraph: EGraph, y=None, use_shrink_action=False, step=None, version=None) -> geom.data.Data:
+        """Encode an egraph as a PyTorch Geometric graph of eclass and enode nodes.
 
-        for rule, ecids in matches.items():
-            for ecid in ecids:
-                eclass_lookup[ecid][self.rule_name_to_ind(rule)] = 1
+        `version` is an optional revision counter that the caller bumps whenever it changes the
+        egraph. When the same egraph is encoded again at the same version, the node features and
+        edges from the previous call are reused instead of re-walking the egraph.
+        """
+        # first_stamp = int(round(time.time() * 1000))
+        cache_key = (id(egraph), version)
+        cached = self._encode_cache.get(cache_key) if version is not None else None
+        if cached is not None:
+            x, edge_index, edge_attr = cached
+        else:
+            x, edge_index, edge_attr = self._encode_egraph_tensors(egraph)
+            if version is not None:
+                # only the most recent encoding is kept
+                self._encode_cache.clear()
+                self._encode_cache[cache_key] = (x, edge_index, edge_attr)
+
+        rule_start = self.num_static_features + self.num_terminals + self.num_operators
+
+        action_mask = x[:, rule_start:].sum(dim=0).clamp(0, 1)
+        if use_shrink_action:
+            action_mask = torch.cat((action_mask, torch.ones(2)))
+            if step < 100:
+                 action_mask[-2] = 0
+        else:
+            action_mask = torch.cat((action_mask, torch.ones(1)))
+            # if step < 100:
+            #     action_mask[-1] = 0
+
+        if y is not None:
+            y = torch.Tensor([y]).long()
 
-        return eclass_lookup
+        data = geom.data.Data(x=x, edge_index=edge_index, edge_attr=edge_attr,
+                              y=y, action_mask=action_mask)
+        # second_stamp = int(round(time.time() * 1000))
+        # Calculate the time taken in milliseconds
+        # time_taken = second_stamp - first_stamp
+        # print("time_taken", time_taken, data)
+        return data
 
-    def encode_egraph(self, egraph: EGraph, y=None, use_shrink_action=False, step=None) -> geom.data.Data:
+    def _encode_egraph_tensors(self, egraph: EGraph):
+        """Node features, edge index and edge attributes of `encode_egraph`."""
         egraph.rebuild()
-        # first_stamp = int(round(time.time() * 1000))
         num_enodes = egraph.num_enodes()
         eclass_ids = egraph.eclass_ids()
         num_eclasses = len(eclass_ids)
-        eclass_enode_edges = torch.zeros([2, num_enodes])
-        eclass_enode_edge_attr = torch.tensor(
-            [1, 0]).expand(eclass_enode_edges.size()[-1], -1)
 
-        x = torch.zeros([num_eclasses + num_enodes, self.num_node_features])
+        x = np.zeros([num_eclasses + num_enodes, self.num_node_features], dtype=np.float32)
         x[:num_eclasses, 0] = 1  # make eclass nodes
         x[num_eclasses:, 1] = 1  # mark enodes
 
         curr = num_eclasses
-        edge_curr = 0
 
         eclass_to_ind = dict(zip(eclass_ids, range(num_eclasses)))
         classes = egraph.classes()
 
-        all_node_edges = []
-
         term_start = self.num_static_features
         op_start = term_start + self.num_terminals
         rule_start = op_start + self.num_operators
 
         matches = egraph.match_rules(self.rewrite_rules())
-        eclass_to_rule_inds = self.matches_to_lookup(eclass_ids, matches)
+        # mark the rules matching each eclass
+        for rule, ecids in matches.items():
+            x[[eclass_to_ind[ecid] for ecid in ecids], rule_start + self.rule_to_ind[rule]] = 1
 
-        for eclass_id, (data, nodes) in classes.items():
-            eclass_ind = eclass_to_ind[eclass_id]
+        op_to_ind = self.op_to_ind
+        terminal_to_ind = self.terminal_to_ind
 
-            x[eclass_ind][rule_start:] = torch.Tensor(
-                eclass_to_rule_inds[eclass_id])
+        # (row, column) of every enode feature to set, applied in one go after the loop
+        feat_rows, feat_cols = [], []
+        # eclass -> member enode edges; the enodes are numbered consecutively so only the eclass is kept
+        member_eclass = []
+        # enode -> child eclass edges
+        child_src, child_dst = [], []
 
-            num_eclass_nodes = len(nodes)
-            # create edges from eclass to member enodes
-            eclass_enode_edges[0, edge_curr:(
-                edge_curr + num_eclass_nodes)] = eclass_ind
-            eclass_enode_edges[1, edge_curr:(
-                edge_curr + num_eclass_nodes)] = torch.arange(curr, curr + num_eclass_nodes)
-            edge_curr = edge_curr + num_eclass_nodes
+        for eclass_id, (data, nodes) in classes.items():
+            eclass_ind = eclass_to_ind[eclass_id]
+            member_eclass += [eclass_ind] * len(nodes)
 
             for node in nodes:
-                # we only want to encode if they're terminals... everything else will cause learning confusion.
-                if isinstance(node, int) or isinstance(node, float) or isinstance(node, bool) or isinstance(node, str) or isinstance(node, np.bool_) or isinstance(node, np.int64):
-                    try:
-                        term_ind = self.get_terminals().index(node)
-                        x[curr, 3] = 1
-                        x[curr, term_start + term_ind] = 1
-                    except ValueError:
+                # every operator enode is an instance of exactly one of the language's op tuples
+                op_ind = op_to_ind.get(type(node))
+                if op_ind is None:
+                    # we only want to encode if they're terminals... everything else will cause learning confusion.
+                    term_ind = terminal_to_ind.get(node)
+                    if term_ind is not None:
+                        feat_rows += [curr, curr]
+                        feat_cols += [3, term_start + term_ind]
+                    else:
                         # it's an unknown scalar (not in terminals list)
-                        x[curr, 2] = 1
+                        feat_rows.append(curr)
+                        feat_cols.append(2)
                 else:
-                    # encode operator type
-                    x[curr, op_start + self.op_to_ind[type(node)]] = 1
-                    # connect to child eclasses
-                    if isinstance(node, tuple):
-                        all_node_edges.append(torch.stack([torch.full([len(node)], curr),
-                                              torch.Tensor([eclass_to_ind[str(ecid)] for ecid in node])]))
+                    # encode operator type and connect to child eclasses
+                    feat_rows.append(curr)
+                    feat_cols.append(op_start + op_ind)
+                    child_src += [curr] * len(node)
+                    child_dst += [eclass_to_ind[str(ecid)] for ecid in node]
                 curr += 1
 
-        edge_index = torch.concat(
-            [eclass_enode_edges, *all_node_edges], dim=1).long()
-
-
-        enode_eclass_edge_attr = torch.Tensor(
-            [0, 1]).expand(torch.concat(all_node_edges, dim=1).size()[-1], -1) if len(all_node_edges) >0 else torch.Tensor([])
-
-        edge_attr = torch.concat(
-            [eclass_enode_edge_attr, enode_eclass_edge_attr])
-
-        edge_index, edge_attr = geom.utils.add_remaining_self_loops(
-            edge_index, edge_attr, fill_value=0.)
-
-        action_mask = x[:, rule_start:].sum(dim=0).clamp(0, 1)
-        if use_shrink_action:
-            action_mask = torch.cat((action_mask, torch.ones(2)))
-            if step < 100:
-                 action_mask[-2] = 0
-        else:
-            action_mask = torch.cat((action_mask, torch.ones(1)))
-            # if step < 100:
-            #     action_mask[-1] = 0
-
-        if y is not None:
-            y = torch.Tensor([y]).long()
-
-        data = geom.data.Data(x=x, edge_index=edge_index, edge_attr=edge_attr,
-                              y=y, action_mask=action_mask)
-        # second_stamp = int(round(time.time() * 1000))
-        # Calculate the time taken in milliseconds
-        # time_taken = second_stamp - first_stamp
-        # print("time_taken", time_taken, data)
-        return data
+        x[feat_rows, feat_cols] = 1
+        x = torch.from_numpy(x)
+
+        # member edges, then child edges, then one self loop per node (the graph is bipartite
+        # so it has none of its own). Edge attrs are [1, 0], [0, 1] and [0, 0] respectively.
+        num_nodes = num_eclasses + num_enodes
+        num_member_edges = len(member_eclass)
+        num_edges = num_member_edges + len(child_src)
+        edge_index = np.empty([2, num_edges + num_nodes], dtype=np.int64)
+        edge_index[0, :num_member_edges] = member_eclass
+        edge_index[1, :num_member_edges] = np.arange(num_eclasses, num_eclasses + num_member_edges)
+        edge_index[0, num_member_edges:num_edges] = child_src
+        edge_index[1, num_member_edges:num_edges] = child_dst
+        edge_index[:, num_edges:] = np.arange(num_nodes)
+        edge_index = torch.from_numpy(edge_index)
+
+        edge_attr = np.zeros([num_edges + num_nodes, 2], dtype=np.float32)
+        edge_attr[:num_member_edges, 0] = 1
+        edge_attr[num_member_edges:num_edges, 1] = 1
+        edge_attr = torch.from_numpy(edge_attr)
+        return x, edge_index, edge_attr
 
     def decode_node(self, node: torch.Tensor):
         term_start = self.num_static_features
@@ -1,4 +1,4 @@
-from typing import Union, Tuple
+from typing import Optional, Union, Tuple
 
 import torch
 from torch import nn
@@ -64,6 +64,54 @@ class GATNetwork(nn.Module):
         return x
 
 
+class GATActorCritic(nn.Module):
+    """A single GAT trunk shared by a policy head and a value head, so both come out of one GNN pass."""
+
+    def __init__(self, num_node_features: int, n_actions: int, n_layers: int = 3, hidden_size: int = 128,
+                 actor_out_std=0.001, critic_out_std=1., dropout=0.0, use_edge_attr=True):
+        super(GATActorCritic, self).__init__()
+        self.use_edge_attr = use_edge_attr
+        self.gnn = GAT(in_channels=num_node_features,
+                       hidden_channels=hidden_size,
+                       out_channels=hidden_size,
+                       num_layers=n_layers,
+                       add_self_loops=False,
+                       dropout=dropout,
+                       norm=pyg.nn.GraphNorm(in_channels=hidden_size),
+                       act="leaky_relu",
+                       v2=True,
+                       edge_dim=(2 if self.use_edge_attr else None))
+        self.actor_head = self._make_head(hidden_size, n_actions, dropout, actor_out_std)
+        self.critic_head = self._make_head(hidden_size, 1, dropout, critic_out_std)
+
+    @staticmethod
+    def _make_head(hidden_size: int, n_out: int, dropout: float, out_std: float):
+        out = nn.Linear(hidden_size, n_out)
+        if dropout == 0.0:
+            out = layer_init(out, std=out_std)
+        return nn.Sequential(nn.Dropout(p=dropout), nn.Linear(hidden_size, hidden_size), nn.LeakyReLU(), out)
+
+    def embed(self, data: Union[pyg.data.Data, pyg.data.Batch], num_graphs: Optional[int] = None):
+        """Pooled graph embeddings of the shared trunk.
+
+        If `num_graphs` is given, the batch holds `num_graphs` real graphs followed by one padding
+        graph. The padding nodes are kept out of the GraphNorm statistics and their embedding is
+        dropped, and every output shape is known without a device sync (needed for CUDA graphs).
+        """
+        edge_attr = data.edge_attr if self.use_edge_attr else None
+        if num_graphs is None:
+            x = self.gnn(x=data.x, edge_index=data.edge_index, edge_attr=edge_attr)
+            return pyg.nn.global_add_pool(x=x, batch=data.batch)
+
+        is_padding = (data.batch == num_graphs).long()
+        x = self.gnn(x=data.x, edge_index=data.edge_index, edge_attr=edge_attr, batch=is_padding, batch_size=2)
+        return pyg.nn.global_add_pool(x=x, batch=data.batch, size=num_graphs + 1)[:num_graphs]
+
+    def forward(self, data: Union[pyg.data.Data, pyg.data.Batch]):
+        h = self.embed(data)
+        return self.actor_head(h), self.critic_head(h)
+
+
 class GINNetwork(nn.Module):
 
     def __init__(self, num_node_features: int, n_actions: int, n_layers: int = 3, hidden_size: int = 128,
@@ -0,0 +1,164 @@
+import math
+
+import torch
+import torch_geometric as pyg
+
+# Smallest (gamma * lambda)^t factor the GAE scan is allowed to divide by. Longer rollouts are
+# split into blocks so the decay never gets near float64 underflow.
+_MIN_GAE_DECAY = 1e-150
+
+
+def gae_decay_table(num_steps: int, gamma: float, gae_lambda: float, device=None):
+    """The (gamma * lambda)^t factors used by `compute_gae`, in float64 since they get small quickly."""
+    return (gamma * gae_lambda) ** torch.arange(num_steps, device=device, dtype=torch.float64)
+
+
+def _gae_block_size(num_steps: int, decay: float) -> int:
+    if decay >= 1.:
+        return num_steps
+    return max(1, min(num_steps, int(math.log(_MIN_GAE_DECAY) / math.log(decay))))
+
+
+def _discounted_segment_sums(deltas, nextnonterminal, gl_pow):
+    """sum_{k=t}^{end(t)} (gamma * lambda)^(k-t) * delta_k, where end(t) is the last step of t's segment."""
+    num_steps = deltas.shape[0]
+    gl_pow = gl_pow.unsqueeze(1)
+    weighted = deltas.double() * gl_pow
+    suffix = torch.flip(torch.cumsum(torch.flip(weighted, [0]), 0), [0])
+    suffix = torch.cat([suffix, torch.zeros_like(suffix[:1])])
+
+    # A trajectory segment ends at t when the following step is terminal (and always at the
+    # last step, whose tail is already bootstrapped through next_value). For every t, find the
+    # end of its segment and subtract everything past it from the reverse cumsum.
+    step_inds = torch.arange(num_steps, device=deltas.device).unsqueeze(1).expand_as(deltas)
+    is_seg_end = nextnonterminal == 0
+    is_seg_end[-1] = True
+    seg_end = torch.where(is_seg_end, step_inds, torch.full_like(step_inds, num_steps))
+    seg_end = torch.flip(torch.cummin(torch.flip(seg_end, [0]), 0).values, [0])
+
+    return (suffix[:-1] - torch.gather(suffix, 0, seg_end + 1)) / gl_pow
+
+
+def compute_gae(rewards, values, dones, next_value, next_done, gamma: float, gae_lambda: float, gl_pow=None):
+    """Vectorized Generalized Advantage Estimation over a (num_steps, num_envs) rollout.
+
+    Equivalent to the usual reversed-time recursion
+    `A_t = delta_t + gamma * lambda * nonterminal_{t+1} * A_{t+1}`, but computed with a
+    reverse cumulative sum instead of one tiny set of kernels per time step.
+    `gl_pow` is an optional precomputed `gae_decay_table`.
+    """
+    num_steps = rewards.shape[0]
+    nextvalues = torch.cat([values[1:], next_value.reshape(1, -1)])
+    nextnonterminal = 1.0 - torch.cat([dones[1:], next_done.reshape(1, -1)])
+    deltas = rewards + gamma * nextvalues * nextnonterminal - values
+
+    decay = gamma * gae_lambda
+    if decay == 0:
+        # the recursion collapses to one step
+        return deltas
+
+    if gl_pow is None:
+        gl_pow = gae_decay_table(num_steps, gamma, gae_lambda, device=rewards.device)
+
+    # Blocks are scanned back to front. The advantage at the start of the later block is folded
+    # into the last delta of the earlier one, exactly as the recursion would carry it.
+    block_size = _gae_block_size(num_steps, decay)
+    advantages = torch.empty_like(deltas)
+    for end in range(num_steps, 0, -block_size):
+        start = max(0, end - block_size)
+        block_deltas = deltas[start:end]
+        if end < num_steps:
+            block_deltas = block_deltas.clone()
+            block_deltas[-1] += decay * nextnonterminal[end - 1] * advantages[end]
+        advantages[start:end] = _discounted_segment_sums(
+            block_deltas, nextnonterminal[start:end], gl_pow[:end - start])
+    return advantages
+
+
+def _offsets(counts):
+    """Exclusive cumulative sum, i.e. the start offset of each segment given the segment sizes."""
+    return torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)[:-1]])
+
+
+class FlatGraphBatch:
+    """A whole rollout of graph observations held as flat node and edge tensors.
+
+    Graphs are stored back to back (in (step, env) order) together with their node and edge
+    counts, so any subset of them can be gathered into a `Batch` with a few index ops.
+    """
+
+    def __init__(self, x, edge_index, edge_attr, num_nodes, num_edges):
+        self.x = x
+        self.edge_index = edge_index
+        self.edge_attr = edge_attr
+        self.num_nodes = num_nodes
+        self.num_edges = num_edges
+        self.node_ptr = _offsets(num_nodes)
+        self.edge_ptr = _offsets(num_edges)
+
+    def __len__(self):
+        return self.num_nodes.numel()
+
+    def __getitem__(self, inds) -> pyg.data.Batch:
+        inds = torch.as_tensor(inds, device=self.x.device)
+        graph_ids = torch.arange(inds.numel(), device=self.x.device)
+        num_nodes = self.num_nodes[inds]
+        num_edges = self.num_edges[inds]
+        src_node_ptr = self.node_ptr[inds]
+        src_edge_ptr = self.edge_ptr[inds]
+
+        batch = torch.repeat_interleave(graph_ids, num_nodes)
+        ptr = torch.cat([num_nodes.new_zeros(1), torch.cumsum(num_nodes, 0)])
+        # position of each node in the new batch, shifted to where its graph starts in the rollout
+        node_inds = torch.arange(batch.numel(), device=self.x.device) - ptr[batch] + src_node_ptr[batch]
+
+        edge_batch = torch.repeat_interleave(graph_ids, num_edges)
+        new_edge_ptr = _offsets(num_edges)
+        edge_inds = torch.arange(edge_batch.numel(), device=self.x.device) - \
+            new_edge_ptr[edge_batch] + src_edge_ptr[edge_batch]
+        edge_index = self.edge_index.index_select(1, edge_inds) - src_node_ptr[edge_batch] + ptr[edge_batch]
+
+        # assembled directly from the gathered tensors, nothing goes through Data objects
+        return pyg.data.Batch(x=self.x.index_select(0, node_inds), edge_index=edge_index,
+                              edge_attr=self.edge_attr.index_select(0, edge_inds), batch=batch, ptr=ptr)
+
+
+class GraphRolloutStorage:
+    """Per-step storage for the batched env observations of a rollout.
+
+    Only the raw tensors of each step's `Batch` are kept; `flatten` concatenates them into a
+    `FlatGraphBatch` without going through `to_data_list` / `from_data_list`.
+    """
+
+    def __init__(self, num_steps: int):
+        self.x = [None] * num_steps
+        self.edge_index = [None] * num_steps
+        self.edge_attr = [None] * num_steps
+        self.num_nodes = [None] * num_steps
+        self.num_edges = [None] * num_steps
+
+    def __setitem__(self, step: int, obs: pyg.data.Batch):
+        self.x[step] = obs.x
+        self.edge_index[step] = obs.edge_index
+        self.edge_attr[step] = obs.edge_attr
+        self.num_nodes[step] = obs.ptr[1:] - obs.ptr[:-1]
+        if "edge_counts" in obs:
+            # per-graph edge counts known on the host at collate time
+            self.num_edges[step] = obs.edge_counts
+        else:
+            # edges of a collated batch are laid out graph by graph, so counting by source node's graph is enough.
+            # bincount syncs on CUDA, so batches staged during rollouts should carry edge_counts
+            self.num_edges[step] = torch.bincount(obs.batch[obs.edge_index[0]], minlength=obs.num_graphs)
+
+    def flatten(self) -> FlatGraphBatch:
+        # each step's edge_index is local to that step's batch; shift it by the step's node offset
+        device = self.x[0].device
+        step_num_nodes = torch.tensor([x.size(0) for x in self.x], device=device)
+        step_num_edges = torch.tensor([ei.size(1) for ei in self.edge_index], device=device)
+        edge_offsets = torch.repeat_interleave(_offsets(step_num_nodes), step_num_edges)
+        edge_index = torch.cat(self.edge_index, dim=1) + edge_offsets
+        return FlatGraphBatch(x=torch.cat(self.x),
+                              edge_index=edge_index,
+                              edge_attr=torch.cat(self.edge_attr),
+                              num_nodes=torch.cat(self.num_nodes),
+                              num_edges=torch.cat(self.num_edges))
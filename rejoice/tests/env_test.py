@@ -1,12 +1,15 @@
 import unittest
 
 import torch
+import torch_geometric as geom
 
 from rejoice import *
 from rejoice.lib import Language
 from test_lang import TestLang
 import gym
 from rejoice import envs, EGraph
+from rejoice.envs.egraph_env import EGraphEnv
+import numpy as np
 
 
 class MyTestCase(unittest.TestCase):
@@ -114,5 +117,138 @@ class MyTestCase(unittest.TestCase):
         self.take_step(env, 1)
 
 
+class TerminalTestLang(TestLang):
+    """TestLang with terminals, so every kind of enode shows up in the encoding."""
+
+    def get_terminals(self) -> list:
+        return [0, 1]
+
+
+def reference_encode(lang: Language, egraph: EGraph):
+    """The (x, edge_index, edge_attr) of the original, tensor-at-a-time encode_egraph."""
+    egraph.rebuild()
+    num_enodes = egraph.num_enodes()
+    eclass_ids = egraph.eclass_ids()
+    num_eclasses = len(eclass_ids)
+    eclass_enode_edges = torch.zeros([2, num_enodes])
+    eclass_enode_edge_attr = torch.tensor([1, 0]).expand(eclass_enode_edges.size()[-1], -1)
+
+    x = torch.zeros([num_eclasses + num_enodes, lang.num_node_features])
+    x[:num_eclasses, 0] = 1
+    x[num_eclasses:, 1] = 1
+
+    curr = num_eclasses
+    edge_curr = 0
+    eclass_to_ind = dict(zip(eclass_ids, range(num_eclasses)))
+    all_node_edges = []
+
+    term_start = lang.num_static_features
+    op_start = term_start + lang.num_terminals
+    rule_start = op_start + lang.num_operators
+
+    eclass_to_rule_inds = {k: [0] * lang.num_rules for k in eclass_ids}
+    for rule, ecids in egraph.match_rules(lang.rewrite_rules()).items():
+        for ecid in ecids:
+            eclass_to_rule_inds[ecid][lang.rule_names.index(rule)] = 1
+
+    for eclass_id, (data, nodes) in egraph.classes().items():
+        eclass_ind = eclass_to_ind[eclass_id]
+        x[eclass_ind][rule_start:] = torch.Tensor(eclass_to_rule_inds[eclass_id])
+
+        num_eclass_nodes = len(nodes)
+        eclass_enode_edges[0, edge_curr:(edge_curr + num_eclass_nodes)] = eclass_ind
+        eclass_enode_edges[1, edge_curr:(edge_curr + num_eclass_nodes)] = torch.arange(curr, curr + num_eclass_nodes)
+        edge_curr = edge_curr + num_eclass_nodes
+
+        for node in nodes:
+            if isinstance(node, (int, float, bool, str, np.bool_, np.int64)):
+                try:
+                    term_ind = lang.get_terminals().index(node)
+                    x[curr, 3] = 1
+                    x[curr, term_start + term_ind] = 1
+                except ValueError:
+                    x[curr, 2] = 1
+            else:
+                x[curr, op_start + lang.op_to_ind[type(node)]] = 1
+                if isinstance(node, tuple):
+                    all_node_edges.append(torch.stack([torch.full([len(node)], curr),
+                                                       torch.Tensor([eclass_to_ind[str(ecid)] for ecid in node])]))
+            curr += 1
+
+    edge_index = torch.concat([eclass_enode_edges, *all_node_edges], dim=1).long()
+    enode_eclass_edge_attr = torch.Tensor([0, 1]).expand(torch.concat(all_node_edges, dim=1).size()[-1], -1)
+    edge_attr = torch.concat([eclass_enode_edge_attr, enode_eclass_edge_attr])
+    return (x,) + geom.utils.add_remaining_self_loops(edge_index, edge_attr, fill_value=0.)
+
+
+class EncodeEGraphTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.lang = TerminalTestLang()
+        self.ops = self.lang.all_operators_obj()
+        # 0 is a terminal, 16, 2 and 4 are unknown scalars
+        self.expr = self.ops.mul(self.ops.add(16, 2), self.ops.mul(4, 0))
+        self.egraph = EGraph()
+        self.egraph.add(self.expr)
+
+    def assert_matches_reference(self):
+        x, edge_index, edge_attr = reference_encode(self.lang, self.egraph)
+        data = self.lang.encode_egraph(self.egraph)
+        torch.testing.assert_close(data.x, x)
+        torch.testing.assert_close(data.edge_index, edge_index)
+        torch.testing.assert_close(data.edge_attr, edge_attr)
+
+    def test_matches_reference(self):
+        self.assert_matches_reference()
+
+    def test_matches_reference_after_rewrites(self):
+        # eclasses with several member enodes
+        self.egraph.run(self.lang.rewrite_rules(), 3)
+        self.assert_matches_reference()
+
+
+class EGraphEnvEncodeCacheTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.lang = TerminalTestLang()
+        ops = self.lang.all_operators_obj()
+        self.env = EGraphEnv(self.lang, ops.mul(ops.add(16, 2), ops.mul(4, 0)), use_shrink_action=True)
+        self.obs = self.env.reset()
+
+    def assert_fresh_encoding(self, obs):
+        self.assertIsNot(obs.x, self.obs.x)
+        self.assertIsNot(obs.edge_index, self.obs.edge_index)
+        self.assertIsNot(obs.edge_attr, self.obs.edge_attr)
+        expected = self.lang.encode_egraph(self.env.egraph)
+        torch.testing.assert_close(obs.x, expected.x)
+        torch.testing.assert_close(obs.edge_index, expected.edge_index)
+        torch.testing.assert_close(obs.edge_attr, expected.edge_attr)
+
+    def test_saturated_step_reuses_encoding(self):
+        # the next step is the first one allowed to rebase
+        self.env.step_count = 99
+        # nothing is multiplied by 1, so this leaves the egraph unchanged
+        obs, _, _, info = self.env.step(self.lang.rule_to_ind["mul-1"])
+        self.assertEqual(info["stop_reason"], "SATURATED")
+        self.assertIs(obs.x, self.obs.x)
+        self.assertIs(obs.edge_index, self.obs.edge_index)
+        self.assertIs(obs.edge_attr, self.obs.edge_attr)
+        # the action mask still depends on the step
+        self.assertEqual(self.obs.action_mask[-2].item(), 0)
+        self.assertEqual(obs.action_mask[-2].item(), 1)
+
+    def test_rewrite_reencodes(self):
+        obs, _, _, info = self.env.step(self.lang.rule_to_ind["commute-add"])
+        self.assertNotEqual(info["stop_reason"], "SATURATED")
+        self.assert_fresh_encoding(obs)
+
+    def test_rebase_reencodes(self):
+        obs, _, _, _ = self.env.step(self.lang.num_rules + 1)
+        self.assert_fresh_encoding(obs)
+
+    def test_reset_reencodes(self):
+        self.assert_fresh_encoding(self.env.reset())
+
+
 if __name__ == '__main__':
     unittest.main()
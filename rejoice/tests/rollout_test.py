@@ -0,0 +1,100 @@
+import unittest
+
+import torch
+import torch_geometric as pyg
+
+from rejoice.rollout import compute_gae, GraphRolloutStorage
+
+
+def reference_gae(rewards, values, dones, next_value, next_done, gamma, gae_lambda):
+    """The reversed-time loop compute_gae replaced."""
+    num_steps = rewards.shape[0]
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = 1.0 - next_done
+            nextvalues = next_value
+        else:
+            nextnonterminal = 1.0 - dones[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    return advantages
+
+
+class ComputeGAETestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+
+    def make_rollout(self, num_steps, num_envs):
+        rewards = torch.randn(num_steps, num_envs, dtype=torch.float64)
+        values = torch.randn(num_steps, num_envs, dtype=torch.float64)
+        dones = (torch.rand(num_steps, num_envs) < 0.2).double()
+        # episode boundaries at the very first and last steps too
+        dones[0, 0] = 1.
+        dones[-1, 1] = 1.
+        next_value = torch.randn(num_envs, dtype=torch.float64)
+        next_done = torch.tensor([1., 0., 1., 0.], dtype=torch.float64)[:num_envs]
+        return rewards, values, dones, next_value, next_done
+
+    def assert_matches_reference(self, rollout, gamma, gae_lambda):
+        expected = reference_gae(*rollout, gamma, gae_lambda)
+        actual = compute_gae(*rollout, gamma=gamma, gae_lambda=gae_lambda)
+        self.assertFalse(torch.isnan(actual).any())
+        torch.testing.assert_close(actual, expected)
+
+    def test_matches_loop(self):
+        self.assert_matches_reference(self.make_rollout(128, 4), gamma=0.99, gae_lambda=0.95)
+
+    def test_zero_lambda_and_gamma(self):
+        rollout = self.make_rollout(32, 4)
+        self.assert_matches_reference(rollout, gamma=0.99, gae_lambda=0.)
+        self.assert_matches_reference(rollout, gamma=0., gae_lambda=0.95)
+
+    def test_no_decay(self):
+        self.assert_matches_reference(self.make_rollout(32, 4), gamma=1., gae_lambda=1.)
+
+    def test_long_rollout(self):
+        # (0.5)^t underflows float64 long before t = 3000, so this is scanned in blocks
+        self.assert_matches_reference(self.make_rollout(3000, 4), gamma=1., gae_lambda=0.5)
+
+
+class GraphRolloutStorageTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.num_steps, self.num_envs = 3, 4
+        self.graphs = [self.random_graph(num_edges=(0 if i == 5 else None))
+                       for i in range(self.num_steps * self.num_envs)]
+        self.storage = GraphRolloutStorage(self.num_steps)
+        for step in range(self.num_steps):
+            step_graphs = self.graphs[step * self.num_envs:(step + 1) * self.num_envs]
+            step_batch = pyg.data.Batch.from_data_list(step_graphs)
+            if step % 2 == 0:
+                # as collated for a rollout, with the counts known up front
+                step_batch.edge_counts = torch.tensor([g.num_edges for g in step_graphs])
+            self.storage[step] = step_batch
+
+    @staticmethod
+    def random_graph(num_edges=None):
+        num_nodes = int(torch.randint(1, 7, ()))
+        if num_edges is None:
+            num_edges = int(torch.randint(1, 10, ()))
+        return pyg.data.Data(x=torch.randn(num_nodes, 5),
+                             edge_index=torch.randint(num_nodes, (2, num_edges)),
+                             edge_attr=torch.randn(num_edges, 2))
+
+    def test_gather_matches_from_data_list(self):
+        flat = self.storage.flatten()
+        self.assertEqual(len(flat), len(self.graphs))
+        inds = torch.randperm(len(self.graphs))
+        actual = flat[inds]
+        expected = pyg.data.Batch.from_data_list([self.graphs[i] for i in inds])
+        for key in ["x", "edge_index", "edge_attr", "batch", "ptr"]:
+            torch.testing.assert_close(actual[key], expected[key], msg=key)
+
+
+if __name__ == '__main__':
+    unittest.main()
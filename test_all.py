@@ -183,7 +183,7 @@ def rollout(lang: Language, expr, device, agent, training_time, num_rollouts=100
         while True:
             obs = lang.encode_egraph(egraph, use_shrink_action=True, step=count).to(device)
             with torch.no_grad():
-                action, *rest = agent.get_action_and_value(obs, invalid_action_mask=obs.action_mask)
+                action, *rest = agent.get_action_and_value(obs, invalid_action_mask=obs.action_mask, compute_value=False)
 
             action = action.item()
             if action == lang.num_rules: